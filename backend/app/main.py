@@ -18,7 +18,7 @@ from app.user import User
 from app.utils import is_running_on_lambda
 from fastapi import Depends, FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, ORJSONResponse
 from fastapi.security import HTTPAuthorizationCredentials
 from pydantic import ValidationError
 from starlette.requests import Request
@@ -49,6 +49,8 @@ else:
 app = FastAPI(
     openapi_tags=openapi_tags,
     title=title,
+    # Use orjson to encode responses faster than the standard json module
+    default_response_class=ORJSONResponse,
 )
 
 
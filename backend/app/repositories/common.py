@@ -1,7 +1,17 @@
 import json
 import os
+from functools import lru_cache
+from threading import Lock, local
+from typing import Any
 
 import boto3
+from botocore.config import Config
+from botocore.credentials import (
+    CredentialProvider,
+    CredentialResolver,
+    RefreshableCredentials,
+)
+from botocore.session import get_session
 
 DDB_ENDPOINT_URL = os.environ.get("DDB_ENDPOINT_URL")
 TABLE_NAME = os.environ.get("TABLE_NAME", "")
@@ -10,6 +20,17 @@ REGION = os.environ.get("REGION", "ap-northeast-1")
 TABLE_ACCESS_ROLE_ARN = os.environ.get("TABLE_ACCESS_ROLE_ARN", "")
 TRANSACTION_BATCH_SIZE = 25
 
+# Share a large keep-alive connection pool across concurrent requests
+# and retry on throttling with client side rate limiting. Short timeouts
+# let a stalled connection fail fast into a retry instead of blocking
+# for the 60 second botocore default.
+DYNAMODB_CONFIG = Config(
+    max_pool_connections=50,
+    retries={"max_attempts": 10, "mode": "adaptive"},
+    connect_timeout=1.0,
+    read_timeout=3.0,
+)
+
 
 class RecordNotFoundError(Exception):
     pass
@@ -23,6 +44,10 @@ class ResourceConflictError(Exception):
     pass
 
 
+class UnprocessedItemsError(Exception):
+    pass
+
+
 def compose_conv_id(user_id: str, conversation_id: str):
     # Add user_id prefix for row level security to match with `LeadingKeys` condition
     return f"{user_id}#CONV#{conversation_id}"
@@ -50,23 +75,67 @@ def decompose_bot_alias_id(composed_alias_id: str):
     return composed_alias_id.split("#")[-1]
 
 
-def _get_aws_resource(service_name, user_id=None):
-    """Get AWS resource with optional row-level access control for DynamoDB.
+def _assume_role_credentials(policy_document: dict) -> RefreshableCredentials:
+    """Assume the table access role. The credentials are refreshed before expiration."""
+    sts_client = boto3.client("sts")
+
+    def refresh():
+        assumed_role_object = sts_client.assume_role(
+            RoleArn=TABLE_ACCESS_ROLE_ARN,
+            RoleSessionName="DynamoDBSession",
+            Policy=json.dumps(policy_document),
+        )
+        credentials = assumed_role_object["Credentials"]
+        return {
+            "access_key": credentials["AccessKeyId"],
+            "secret_key": credentials["SecretAccessKey"],
+            "token": credentials["SessionToken"],
+            "expiry_time": credentials["Expiration"].isoformat(),
+        }
+
+    return RefreshableCredentials.create_from_metadata(
+        metadata=refresh(), refresh_using=refresh, method="sts-assume-role"
+    )
+
+
+class _AssumeRoleCredentialProvider(CredentialProvider):
+    """Provide credentials of the table access role scoped down by the policy."""
+
+    METHOD = "sts-assume-role"
+
+    def __init__(self, policy_document: dict):
+        super().__init__()
+        self.policy_document = policy_document
+
+    def load(self):
+        return _assume_role_credentials(self.policy_document)
+
+
+# NOTE: boto3 sessions and resources are not thread safe, while low-level clients are.
+# Sessions are shared but clients and resources are created from them under the lock,
+# and resources are cached per thread.
+# Ref: https://boto3.amazonaws.com/v1/documentation/api/latest/guide/resources.html#multithreading-or-multiprocessing-with-resources
+_session_lock = Lock()
+_thread_local = local()
+
+
+@lru_cache(maxsize=1024)
+def _get_aws_session(user_id=None) -> boto3.Session:
+    """Get AWS session with optional row-level access control for DynamoDB.
+    The session is cached per user to reuse credentials across requests.
     Ref: https://docs.aws.amazon.com/IAM/latest/UserGuide/reference_policies_examples_dynamodb_items.html
     """
     if "AWS_EXECUTION_ENV" not in os.environ:
         if DDB_ENDPOINT_URL:
-            return boto3.resource(
-                service_name,
-                endpoint_url=DDB_ENDPOINT_URL,
+            return boto3.Session(
                 aws_access_key_id="key",
                 aws_secret_access_key="key",
                 region_name=REGION,
             )
         else:
-            return boto3.resource(service_name, region_name=REGION)
+            return boto3.Session(region_name=REGION)
 
-    policy_document = {
+    policy_document: dict[str, Any] = {
         "Statement": [
             {
                 "Effect": "Allow",
@@ -96,24 +165,62 @@ def _get_aws_resource(service_name, user_id=None):
             "ForAllValues:StringLike": {"dynamodb:LeadingKeys": [f"{user_id}*"]}
         }
 
-    sts_client = boto3.client("sts")
-    assumed_role_object = sts_client.assume_role(
-        RoleArn=TABLE_ACCESS_ROLE_ARN,
-        RoleSessionName="DynamoDBSession",
-        Policy=json.dumps(policy_document),
+    botocore_session = get_session()
+    # Resolve credentials only from the assumed role instead of the default chain
+    botocore_session.register_component(
+        "credential_provider",
+        CredentialResolver(providers=[_AssumeRoleCredentialProvider(policy_document)]),
     )
-    credentials = assumed_role_object["Credentials"]
-    session = boto3.Session(
-        aws_access_key_id=credentials["AccessKeyId"],
-        aws_secret_access_key=credentials["SecretAccessKey"],
-        aws_session_token=credentials["SessionToken"],
-    )
-    return session.resource(service_name, region_name=REGION)
+    return boto3.Session(botocore_session=botocore_session, region_name=REGION)
+
+
+def _get_endpoint_url() -> str | None:
+    if "AWS_EXECUTION_ENV" not in os.environ:
+        return DDB_ENDPOINT_URL
+    return None
+
+
+def _create_aws_resource(service_name, user_id=None):
+    session = _get_aws_session(user_id)
+    with _session_lock:
+        return session.resource(
+            service_name,
+            endpoint_url=_get_endpoint_url(),
+            region_name=REGION,
+            config=DYNAMODB_CONFIG,
+        )
+
+
+def _get_aws_resource(service_name, user_id=None):
+    """Get AWS resource with optional row-level access control for DynamoDB.
+    The resource is cached per user and thread to reuse connections across requests.
+    """
+    if not hasattr(_thread_local, "get_aws_resource"):
+        _thread_local.get_aws_resource = lru_cache(maxsize=1024)(_create_aws_resource)
+    return _thread_local.get_aws_resource(service_name, user_id)
+
+
+@lru_cache(maxsize=1024)
+def _get_aws_client(service_name, user_id=None):
+    """Get low-level AWS client with optional row-level access control for DynamoDB.
+    Unlike the resource, attributes are not (de)serialized automatically.
+    The client is thread safe, so it is shared across threads.
+    """
+    session = _get_aws_session(user_id)
+    with _session_lock:
+        return session.client(
+            service_name,
+            endpoint_url=_get_endpoint_url(),
+            region_name=REGION,
+            config=DYNAMODB_CONFIG,
+        )
 
 
 def _get_dynamodb_client(user_id=None):
-    """Get a DynamoDB client, optionally with row-level access control."""
-    return _get_aws_resource("dynamodb", user_id=user_id).meta.client
+    """Get a low-level DynamoDB client, optionally with row-level access control.
+    Items are in DynamoDB JSON format e.g. `{"S": "value"}`.
+    """
+    return _get_aws_client("dynamodb", user_id=user_id)
 
 
 def _get_table_client(user_id):
@@ -1,14 +1,20 @@
-import json
 import logging
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from decimal import Decimal as decimal
 from functools import wraps
 
 import boto3
+import orjson
+import zstandard
 from app.repositories.common import (
     TRANSACTION_BATCH_SIZE,
+    TABLE_NAME,
     RecordNotFoundError,
+    UnprocessedItemsError,
+    _get_dynamodb_client,
     _get_table_client,
     compose_conv_id,
     decompose_conv_id,
@@ -22,21 +28,134 @@ from app.repositories.models.conversation import (
     MessageModel,
 )
 from app.utils import get_current_time
-from boto3.dynamodb.conditions import Key
+from boto3.dynamodb.types import Binary, TypeDeserializer
 from botocore.exceptions import ClientError
+from pydantic import TypeAdapter
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 s3_client = boto3.client("s3")
+executor = ThreadPoolExecutor(max_workers=8)
+message_map_adapter = TypeAdapter(dict[str, MessageModel])
+conversation_meta_adapter = TypeAdapter(list[ConversationMeta])
 
 THRESHOLD_LARGE_MESSAGE = 300 * 1024  # 300KB
+MESSAGE_MAP_COMPRESSION_LEVEL = 3
 LARGE_MESSAGE_BUCKET = os.environ.get("LARGE_MESSAGE_BUCKET")
+MAX_BATCH_WRITE_RETRIES = 5
+BATCH_GET_SIZE = 100
+BATCH_WRITE_RETRY_BASE_DELAY = 0.05  # seconds
+
+# NOTE: Need SK to fetch only conversations
+CONVERSATION_KEY_CONDITION = "PK = :pk AND begins_with(SK, :sk_prefix)"
+
+
+def _to_dynamodb_message_map(message_map: dict[str, dict]) -> dict[str, dict]:
+    """Convert dumped message map to DynamoDB native Map attribute in place.
+    Stored as a map (not a JSON string) so that a single message can be updated in place.
+    """
+    for message in message_map.values():
+        # DynamoDB does not accept float. Convert to decimal via str to avoid error
+        message["create_time"] = decimal(str(message["create_time"]))
+    return message_map
+
+
+def _load_message_map(message_map: str | dict | Binary) -> dict:
+    # Large message map is stored as zstd compressed JSON
+    if isinstance(message_map, Binary):
+        return orjson.loads(zstandard.ZstdDecompressor().decompress(message_map.value))
+    # For backward compatibility, `MessageMap` may be stored as JSON string
+    if isinstance(message_map, str):
+        return orjson.loads(message_map)
+    return message_map
+
+
+def _compose_conversation_key_values(user_id: str) -> dict:
+    """Values for `CONVERSATION_KEY_CONDITION` in low-level client format."""
+    return {":pk": {"S": user_id}, ":sk_prefix": {"S": f"{user_id}#CONV#"}}
+
+
+def _upgrade_legacy_message(message: dict) -> dict:
+    """Fill fields which are missing in messages stored by older versions."""
+    if (
+        type(message["content"]) == list
+        and "feedback" in message
+        and "used_chunks" in message
+    ):
+        return message
+
+    return {
+        **message,
+        "content": (
+            message["content"]
+            if type(message["content"]) == list
+            # For backward compatibility
+            else [{**message["content"], "media_type": None}]
+        ),
+        "feedback": message.get("feedback") or None,
+        "used_chunks": message.get("used_chunks") or None,
+    }
+
+
+def _get_first_message_model(message_map: dict[str, MessageModel]) -> str:
+    if "system" in message_map:
+        return message_map["system"].model
+    return next(iter(message_map.values())).model if message_map else ""
+
+
+def _find_first_message_models(
+    client,
+    user_id: str,
+    composed_conv_ids: list[str],
+    max_retries=MAX_BATCH_WRITE_RETRIES,
+) -> dict[str, str]:
+    """Load the model from `MessageMap` for items stored before `FirstMessageModel` was introduced.
+    All items are fetched with `BatchGetItem` instead of one `GetItem` per item.
+    Returns a dict of composed conversation id to model.
+    """
+    deserializer = TypeDeserializer()
+    models: dict[str, str] = {}
+    for i in range(0, len(composed_conv_ids), BATCH_GET_SIZE):
+        request_items = {
+            TABLE_NAME: {
+                "Keys": [
+                    {"PK": {"S": user_id}, "SK": {"S": composed_conv_id}}
+                    for composed_conv_id in composed_conv_ids[i : i + BATCH_GET_SIZE]
+                ],
+                "ProjectionExpression": "SK, MessageMap",
+            }
+        }
+        attempt = 0
+        while request_items:
+            response = client.batch_get_item(RequestItems=request_items)
+            items = response["Responses"].get(TABLE_NAME, [])
+            for item in items:
+                if "MessageMap" not in item:
+                    continue
+                message_map = _load_message_map(
+                    deserializer.deserialize(item["MessageMap"])
+                )
+                models[item["SK"]["S"]] = message_map.get("system", {}).get("model", "")
+
+            # NOTE: Keys exceeding 16MB response limit or throttled are returned as `UnprocessedKeys`
+            request_items = response.get("UnprocessedKeys", {})
+            if request_items and not items:
+                if attempt >= max_retries:
+                    raise UnprocessedItemsError(
+                        f"Failed to get {len(request_items[TABLE_NAME]['Keys'])} items after {max_retries} retries"
+                    )
+                time.sleep(BATCH_WRITE_RETRY_BASE_DELAY * 2**attempt)
+                attempt += 1
+    return models
 
 
 def store_conversation(
     user_id: str, conversation: ConversationModel, threshold=THRESHOLD_LARGE_MESSAGE
 ):
-    logger.info(f"Storing conversation: {conversation.model_dump_json()}")
+    logger.info(f"Storing conversation: {conversation.id}")
+    # NOTE: Avoid serializing whole conversation unless debug logging is enabled
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Conversation: %s", conversation.model_dump_json())
     table = _get_table_client(user_id)
 
     item_params = {
@@ -53,187 +172,173 @@ def store_conversation(
     if conversation.bot_id:
         item_params["BotId"] = conversation.bot_id
 
-    message_map = {
-        k: {
-            **v.model_dump(),
-            "content": [c.model_dump() for c in v.content],
-        }
-        for k, v in conversation.message_map.items()
-    }
-    message_map_size = len(json.dumps(message_map).encode("utf-8"))
+    # NOTE: all message has the same model.
+    # Stored separately so that listing conversations does not need to load `MessageMap`.
+    first_message_model = _get_first_message_model(conversation.message_map)
+    if first_message_model:
+        item_params["FirstMessageModel"] = first_message_model
+
+    # NOTE: The whole item is put on every turn instead of appending new messages in place
+    # with `UpdateItem`. Write capacity of `UpdateItem` is charged for the whole item anyway,
+    # and the total size is needed to choose between map, compressed binary and S3.
+    # Only the feedback is updated in place (see `update_feedback`).
+    # NOTE: Dump models only once. The dumped dicts are stored as the map attribute
+    # and the JSON encoded from them is used to measure size, compress and store in S3.
+    message_map = message_map_adapter.dump_python(conversation.message_map)
+    message_map_json = orjson.dumps(message_map)
+    message_map_size = len(message_map_json)
     logger.info(f"Message map size: {message_map_size}")
-    if message_map_size > threshold:
+    large_message_path = f"{user_id}/{conversation.id}/message_map.json"
+    # Message map previously stored in S3 to be deleted after the item is written
+    stale_large_message_path = None
+    if message_map_size <= threshold:
+        item_params["IsLargeMessage"] = False
+        item_params["MessageMap"] = _to_dynamodb_message_map(message_map)
+    else:
         logger.info(
             f"Message map size {message_map_size} exceeds threshold {threshold}"
         )
-        item_params["IsLargeMessage"] = True
-        large_message_path = f"{user_id}/{conversation.id}/message_map.json"
-        item_params["LargeMessagePath"] = large_message_path
-        # Store all message in S3
-        s3_client.put_object(
-            Bucket=LARGE_MESSAGE_BUCKET,
-            Key=large_message_path,
-            Body=json.dumps(message_map),
-        )
-        # Store only `system` attribute in DynamoDB
-        item_params["MessageMap"] = json.dumps(
-            {
-                k: v.model_dump()
-                for k, v in conversation.message_map.items()
-                if k == "system"
-            }
-        )
-    else:
-        item_params["IsLargeMessage"] = False
-        item_params["MessageMap"] = json.dumps(
-            {k: v.model_dump() for k, v in conversation.message_map.items()}
-        )
+        compressed_message_map = zstandard.ZstdCompressor(
+            level=MESSAGE_MAP_COMPRESSION_LEVEL
+        ).compress(message_map_json)
+        logger.info(f"Compressed message map size: {len(compressed_message_map)}")
+        if len(compressed_message_map) <= threshold:
+            item_params["IsLargeMessage"] = False
+            # Store compressed message map as binary attribute
+            item_params["MessageMap"] = Binary(compressed_message_map)
+            # NOTE: Message map only grows, so a conversation previously stored in S3
+            # always ends up here. Delete the S3 object which is no longer referenced.
+            stale_large_message_path = large_message_path
+        else:
+            item_params["IsLargeMessage"] = True
+            item_params["LargeMessagePath"] = large_message_path
+            # Store all message in S3
+            s3_client.put_object(
+                Bucket=LARGE_MESSAGE_BUCKET,
+                Key=large_message_path,
+                Body=message_map_json,
+            )
+            # Store only `system` attribute in DynamoDB
+            item_params["MessageMap"] = _to_dynamodb_message_map(
+                {k: v for k, v in message_map.items() if k == "system"}
+            )
 
     response = table.put_item(
         Item=item_params,
     )
+    if stale_large_message_path:
+        # NOTE: Deleting non-existent object succeeds
+        s3_client.delete_object(
+            Bucket=LARGE_MESSAGE_BUCKET, Key=stale_large_message_path
+        )
     return response
 
 
 def find_conversation_by_user_id(user_id: str) -> list[ConversationMeta]:
     logger.info(f"Finding conversations for user: {user_id}")
-    table = _get_table_client(user_id)
+    # NOTE: Use low-level client to read only the required attributes
+    # without deserializing whole items on the resource layer.
+    client = _get_dynamodb_client(user_id)
 
     query_params = {
-        "KeyConditionExpression": Key("PK").eq(user_id)
-        # NOTE: Need SK to fetch only conversations
-        & Key("SK").begins_with(f"{user_id}#CONV#"),
+        "TableName": TABLE_NAME,
+        "KeyConditionExpression": CONVERSATION_KEY_CONDITION,
+        "ExpressionAttributeValues": _compose_conversation_key_values(user_id),
+        # NOTE: Fetch only attributes required for `ConversationMeta` to avoid loading `MessageMap`
+        "ProjectionExpression": "SK, Title, CreateTime, BotId, FirstMessageModel",
         "ScanIndexForward": False,
     }
 
-    response = table.query(**query_params)
-    conversations = [
-        ConversationMeta(
-            id=decompose_conv_id(item["SK"]),
-            create_time=float(item["CreateTime"]),
-            title=item["Title"],
-            # NOTE: all message has the same model
-            model=json.loads(item["MessageMap"]).get("system", {}).get("model", ""),
-            bot_id=item["BotId"] if "BotId" in item else None,
-        )
-        for item in response["Items"]
-    ]
+    # Rows of items stored without `FirstMessageModel`, keyed by composed conversation id
+    legacy_rows: dict[str, dict] = {}
+
+    def to_meta(item: dict) -> dict:
+        row = {
+            "id": decompose_conv_id(item["SK"]["S"]),
+            "create_time": item["CreateTime"]["N"],
+            "title": item["Title"]["S"],
+            "model": "",
+            "bot_id": item["BotId"]["S"] if "BotId" in item else None,
+        }
+        if "FirstMessageModel" in item:
+            row["model"] = item["FirstMessageModel"]["S"]
+        else:
+            # For backward compatibility, resolved after all pages are loaded
+            legacy_rows[item["SK"]["S"]] = row
+        return row
+
+    response = client.query(**query_params)
+    rows: list[dict] = []
 
     query_count = 1
     MAX_QUERY_COUNT = 5
-    while "LastEvaluatedKey" in response:
-        model = (
-            json.loads(response["Items"][0]["MessageMap"])
-            .get("system", {})
-            .get("model", "")
-        )
-        query_params["ExclusiveStartKey"] = response["LastEvaluatedKey"]
-        # NOTE: max page size is 1MB
-        # See: https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/Query.Pagination.html
-        response = table.query(
-            **query_params,
-        )
-        conversations.extend(
-            [
-                ConversationMeta(
-                    id=decompose_conv_id(item["SK"]),
-                    create_time=float(item["CreateTime"]),
-                    title=item["Title"],
-                    model=model,
-                    bot_id=item["BotId"] if "BotId" in item else None,
-                )
-                for item in response["Items"]
-            ]
-        )
-        query_count += 1
-        if query_count > MAX_QUERY_COUNT:
-            logger.warning(f"Query count exceeded {MAX_QUERY_COUNT}")
+    while True:
+        next_page = None
+        if "LastEvaluatedKey" in response:
+            if query_count > MAX_QUERY_COUNT:
+                logger.warning(f"Query count exceeded {MAX_QUERY_COUNT}")
+            else:
+                query_params["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+                # NOTE: max page size is 1MB
+                # See: https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/Query.Pagination.html
+                # Prefetch the next page so that the round trip overlaps with converting the current page.
+                next_page = executor.submit(client.query, **query_params)
+                query_count += 1
+
+        rows.extend([to_meta(item) for item in response["Items"]])
+
+        if next_page is None:
             break
+        response = next_page.result()
 
-    logger.info(f"Found conversations: {conversations}")
+    if legacy_rows:
+        logger.info(
+            f"Loading model of {len(legacy_rows)} conversations without FirstMessageModel"
+        )
+        models = _find_first_message_models(client, user_id, list(legacy_rows))
+        for composed_conv_id, model in models.items():
+            legacy_rows[composed_conv_id]["model"] = model
+
+    # NOTE: Validate all rows at once
+    conversations = conversation_meta_adapter.validate_python(rows)
+    logger.info(f"Found {len(conversations)} conversations")
+    logger.debug("Found conversations: %s", conversations)
     return conversations
 
 
 def find_conversation_by_id(user_id: str, conversation_id: str) -> ConversationModel:
     logger.info(f"Finding conversation: {conversation_id}")
     table = _get_table_client(user_id)
-    response = table.query(
-        IndexName="SKIndex",
-        KeyConditionExpression=Key("SK").eq(compose_conv_id(user_id, conversation_id)),
+    # NOTE: Primary key is fully known, so fetch from base table instead of querying the index
+    response = table.get_item(
+        Key={"PK": user_id, "SK": compose_conv_id(user_id, conversation_id)}
     )
-    if len(response["Items"]) == 0:
+    if "Item" not in response:
         raise RecordNotFoundError(f"No conversation found with id: {conversation_id}")
 
-    # NOTE: conversation is unique
-    item = response["Items"][0]
+    item = response["Item"]
     if item.get("IsLargeMessage", False):
         large_message_path = item["LargeMessagePath"]
         response = s3_client.get_object(
             Bucket=LARGE_MESSAGE_BUCKET, Key=large_message_path
         )
-        message_map = json.loads(response["Body"].read().decode("utf-8"))
+        message_map = orjson.loads(response["Body"].read())
     else:
-        message_map = json.loads(item["MessageMap"])
+        message_map = _load_message_map(item["MessageMap"])
 
-    conv = ConversationModel(
+    conv = ConversationModel.model_construct(
         id=decompose_conv_id(item["SK"]),
         create_time=float(item["CreateTime"]),
         title=item["Title"],
-        total_price=item.get("TotalPrice", 0),
-        message_map={
-            k: MessageModel(
-                role=v["role"],
-                content=(
-                    [
-                        ContentModel(
-                            content_type=c["content_type"],
-                            body=c["body"],
-                            media_type=c["media_type"],
-                        )
-                        for c in v["content"]
-                    ]
-                    if type(v["content"]) == list
-                    else [
-                        # For backward compatibility
-                        ContentModel(
-                            content_type=v["content"]["content_type"],
-                            body=v["content"]["body"],
-                            media_type=None,
-                        )
-                    ]
-                ),
-                model=v["model"],
-                children=v["children"],
-                parent=v["parent"],
-                create_time=float(v["create_time"]),
-                feedback=(
-                    FeedbackModel(
-                        thumbs_up=v["feedback"]["thumbs_up"],
-                        category=v["feedback"]["category"],
-                        comment=v["feedback"]["comment"],
-                    )
-                    if v.get("feedback")
-                    else None
-                ),
-                used_chunks=(
-                    [
-                        ChunkModel(
-                            content=c["content"],
-                            source=c["source"],
-                            rank=c["rank"],
-                        )
-                        for c in v["used_chunks"]
-                    ]
-                    if v.get("used_chunks")
-                    else None
-                ),
-            )
-            for k, v in message_map.items()
-        },
+        total_price=float(item.get("TotalPrice", 0)),
+        # NOTE: Validate all messages at once
+        message_map=message_map_adapter.validate_python(
+            {k: _upgrade_legacy_message(v) for k, v in message_map.items()}
+        ),
         last_message_id=item["LastMessageId"],
         bot_id=item["BotId"] if "BotId" in item else None,
     )
-    logger.info(f"Found conversation: {conv}")
+    logger.debug("Found conversation: %s", conv)
     return conv
 
 
@@ -272,51 +377,76 @@ def delete_conversation_by_id(user_id: str, conversation_id: str):
     return response
 
 
+def _batch_delete_items(client, keys: list[dict], max_retries=MAX_BATCH_WRITE_RETRIES):
+    """Delete up to `TRANSACTION_BATCH_SIZE` items with a single `BatchWriteItem`.
+    Unprocessed items are retried with exponential backoff.
+    Raise `UnprocessedItemsError` if any item is still unprocessed after `max_retries`.
+    """
+    request_items = {TABLE_NAME: [{"DeleteRequest": {"Key": key}} for key in keys]}
+    for attempt in range(max_retries + 1):
+        response = client.batch_write_item(RequestItems=request_items)
+        request_items = response.get("UnprocessedItems", {})
+        if not request_items:
+            return
+        if attempt < max_retries:
+            time.sleep(BATCH_WRITE_RETRY_BASE_DELAY * 2**attempt)
+
+    raise UnprocessedItemsError(
+        f"Failed to delete {len(request_items[TABLE_NAME])} items after {max_retries} retries"
+    )
+
+
 def delete_conversation_by_user_id(user_id: str):
     logger.info(f"Deleting ALL conversations for user: {user_id}")
-    table = _get_table_client(user_id)
+    client = _get_dynamodb_client(user_id)
 
     query_params = {
-        "KeyConditionExpression": Key("PK").eq(user_id)
-        # NOTE: Need SK to fetch only conversations
-        & Key("SK").begins_with(f"{user_id}#CONV#"),
+        "TableName": TABLE_NAME,
+        "KeyConditionExpression": CONVERSATION_KEY_CONDITION,
+        "ExpressionAttributeValues": _compose_conversation_key_values(user_id),
         "ProjectionExpression": "SK, IsLargeMessage, LargeMessagePath",
     }
 
-    def delete_batch(batch):
-        with table.batch_writer() as writer:
-            for item in batch:
-                writer.delete_item(Key={"PK": user_id, "SK": item["SK"]})
-
     def delete_large_messages(items):
         for item in items:
-            if item.get("IsLargeMessage", False):
+            if item.get("IsLargeMessage", {}).get("BOOL", False):
                 s3_client.delete_object(
-                    Bucket=LARGE_MESSAGE_BUCKET, Key=item["LargeMessagePath"]
+                    Bucket=LARGE_MESSAGE_BUCKET, Key=item["LargeMessagePath"]["S"]
                 )
 
     try:
-        response = table.query(
+        response = client.query(
             **query_params,
         )
 
         while True:
-            items = response.get("Items", [])
-            delete_large_messages(items)
+            next_page = None
+            if "LastEvaluatedKey" in response:
+                # Prefetch next page while the current page is being deleted
+                query_params["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+                next_page = executor.submit(client.query, **query_params)
 
+            items = response.get("Items", [])
+            # Send batches concurrently to overlap the round trips
+            futures = [executor.submit(delete_large_messages, items)]
             for i in range(0, len(items), TRANSACTION_BATCH_SIZE):
                 batch = items[i : i + TRANSACTION_BATCH_SIZE]
-                delete_batch(batch)
+                futures.append(
+                    executor.submit(
+                        _batch_delete_items,
+                        client,
+                        [{"PK": {"S": user_id}, "SK": item["SK"]} for item in batch],
+                    )
+                )
+            for future in futures:
+                future.result()
 
             # Check if next page exists
-            if "LastEvaluatedKey" not in response:
+            if next_page is None:
                 break
 
             # Load next page
-            query_params["ExclusiveStartKey"] = response["LastEvaluatedKey"]
-            response = table.query(
-                **query_params,
-            )
+            response = next_page.result()
 
     except ClientError as e:
         logger.error(f"An error occurred: {e.response['Error']['Message']}")
@@ -355,21 +485,30 @@ def update_feedback(
 ):
     logger.info(f"Updating feedback for conversation: {conversation_id}")
     table = _get_table_client(user_id)
-    conv = find_conversation_by_id(user_id, conversation_id)
-    message_map = conv.message_map
-    message_map[message_id].feedback = feedback
-
-    response = table.update_item(
-        Key={
-            "PK": user_id,
-            "SK": compose_conv_id(user_id, conversation_id),
-        },
-        UpdateExpression="set MessageMap = :m",
-        ExpressionAttributeValues={
-            ":m": json.dumps({k: v.model_dump() for k, v in message_map.items()})
-        },
-        ConditionExpression="attribute_exists(PK) AND attribute_exists(SK)",
-        ReturnValues="UPDATED_NEW",
-    )
+
+    try:
+        # Update only the feedback of the message in place
+        response = table.update_item(
+            Key={
+                "PK": user_id,
+                "SK": compose_conv_id(user_id, conversation_id),
+            },
+            UpdateExpression="set MessageMap.#message_id.feedback = :f",
+            ExpressionAttributeNames={"#message_id": message_id},
+            ExpressionAttributeValues={":f": feedback.model_dump(), ":map": "M"},
+            ConditionExpression=(
+                "attribute_exists(PK) AND attribute_exists(SK)"
+                " AND attribute_type(MessageMap, :map)"
+                " AND attribute_exists(MessageMap.#message_id)"
+            ),
+            ReturnValues="UPDATED_NEW",
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise e
+        # For backward compatibility or large message, rewrite whole conversation
+        conv = find_conversation_by_id(user_id, conversation_id)
+        conv.message_map[message_id].feedback = feedback
+        response = store_conversation(user_id, conv)
     logger.info(f"Updated feedback response: {response}")
     return response
@@ -24,7 +24,7 @@ from app.usecases.chat import (
     propose_conversation_title,
 )
 from app.user import User
-from fastapi import APIRouter, Request
+from fastapi import APIRouter, Request, Response
 
 router = APIRouter(tags=["conversation"])
 
@@ -66,7 +66,11 @@ def get_conversation(request: Request, conversation_id: str):
     current_user: User = request.state.current_user
 
     output = fetch_conversation(current_user.id, conversation_id)
-    return output
+    # NOTE: Serialize the message map only once. Returning the model lets FastAPI
+    # dump it to dict, validate it again and encode the result.
+    return Response(
+        content=output.model_dump_json(by_alias=True), media_type="application/json"
+    )
 
 
 @router.delete("/conversation/{conversation_id}")
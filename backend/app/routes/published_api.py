@@ -11,7 +11,7 @@ from app.routes.schemas.published_api import (
 )
 from app.usecases.chat import chat, fetch_conversation
 from app.user import User
-from fastapi import APIRouter, HTTPException, Request
+from fastapi import APIRouter, HTTPException, Request, Response
 from ulid import ULID
 
 router = APIRouter(tags=["published_api"])
@@ -76,7 +76,11 @@ def get_conversation(request: Request, conversation_id: str):
     current_user: User = request.state.current_user
 
     output = fetch_conversation(current_user.id, conversation_id)
-    return output
+    # NOTE: Serialize the message map only once. Returning the model lets FastAPI
+    # dump it to dict, validate it again and encode the result.
+    return Response(
+        content=output.model_dump_json(by_alias=True), media_type="application/json"
+    )
 
 
 @router.get(
@@ -1,5 +1,6 @@
 import json
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 from datetime import datetime
 from typing import Literal
@@ -55,6 +56,8 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
 client = get_anthropic_client()
+# NOTE: Used to update bot last used time while storing conversation
+bot_update_executor = ThreadPoolExecutor(max_workers=4)
 
 
 def prepare_conversation(
@@ -67,7 +70,7 @@ def prepare_conversation(
     try:
         # Fetch existing conversation
         conversation = find_conversation_by_id(user_id, chat_input.conversation_id)
-        logger.info(f"Found conversation: {conversation}")
+        logger.info(f"Found conversation: {conversation.id}")
         parent_id = chat_input.message.parent_message_id
         if chat_input.message.parent_message_id == "system" and chat_input.bot_id:
             # The case editing first user message and use bot
@@ -228,6 +231,26 @@ def insert_knowledge(
     return conversation_with_context
 
 
+def store_conversation_and_bot_last_used_time(
+    user_id: str, conversation: ConversationModel, bot_id: str | None
+):
+    """Store conversation and update last used time of the bot if provided."""
+    if not bot_id:
+        store_conversation(user_id, conversation)
+        return
+
+    logger.info("Bot id is provided. Updating bot last used time.")
+    # NOTE: Conversation and bot are independent items, so both writes are issued
+    # concurrently instead of in a transaction which costs twice the write capacity.
+    future = bot_update_executor.submit(modify_bot_last_used_time, user_id, bot_id)
+    store_conversation(user_id, conversation)
+    try:
+        future.result()
+    except Exception as e:
+        # NOTE: Last used time is best-effort bookkeeping, so never fail the chat
+        logger.error(f"Failed to update bot last used time: {e}")
+
+
 def chat(user_id: str, chat_input: ChatInput) -> ChatOutput:
     user_msg_id, conversation, bot = prepare_conversation(user_id, chat_input)
 
@@ -314,13 +337,8 @@ def chat(user_id: str, chat_input: ChatInput) -> ChatOutput:
     price = calculate_price(chat_input.message.model, input_tokens, output_tokens)
     conversation.total_price += price
 
-    # Store updated conversation
-    store_conversation(user_id, conversation)
-    # Update bot last used time
-    if chat_input.bot_id:
-        logger.info("Bot id is provided. Updating bot last used time.")
-        # Update bot last used time
-        modify_bot_last_used_time(user_id, chat_input.bot_id)
+    # Store updated conversation and update bot last used time
+    store_conversation_and_bot_last_used_time(user_id, conversation, chat_input.bot_id)
 
     output = ChatOutput(
         conversation_id=conversation.id,
@@ -424,11 +442,12 @@ def propose_conversation_title(
 def fetch_conversation(user_id: str, conversation_id: str) -> Conversation:
     conversation = find_conversation_by_id(user_id, conversation_id)
 
+    # NOTE: Conversation is already validated, so skip validation for performance
     message_map = {
-        message_id: MessageOutput(
+        message_id: MessageOutput.model_construct(
             role=message.role,
             content=[
-                Content(
+                Content.model_construct(
                     content_type=c.content_type,
                     body=c.body,
                     media_type=c.media_type,
@@ -439,7 +458,7 @@ def fetch_conversation(user_id: str, conversation_id: str) -> Conversation:
             children=message.children,
             parent=message.parent,
             feedback=(
-                FeedbackOutput(
+                FeedbackOutput.model_construct(
                     thumbs_up=message.feedback.thumbs_up,
                     category=message.feedback.category,
                     comment=message.feedback.comment,
@@ -449,7 +468,7 @@ def fetch_conversation(user_id: str, conversation_id: str) -> Conversation:
             ),
             used_chunks=(
                 [
-                    Chunk(
+                    Chunk.model_construct(
                         content=c.content,
                         source=c.source,
                         rank=c.rank,
@@ -470,7 +489,7 @@ def fetch_conversation(user_id: str, conversation_id: str) -> Conversation:
 
         del message_map["instruction"]
 
-    output = Conversation(
+    output = Conversation.model_construct(
         id=conversation_id,
         title=conversation.title,
         create_time=conversation.create_time,
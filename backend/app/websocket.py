@@ -11,14 +11,14 @@ from anthropic.types import Message as AnthropicMessage
 from anthropic.types import MessageDeltaEvent, MessageStopEvent
 from app.auth import verify_token
 from app.bedrock import calculate_price, compose_args
-from app.repositories.conversation import RecordNotFoundError, store_conversation
+from app.repositories.conversation import RecordNotFoundError
 from app.repositories.models.conversation import ChunkModel, ContentModel, MessageModel
 from app.routes.schemas.conversation import ChatInputWithToken
-from app.usecases.bot import modify_bot_last_used_time
 from app.usecases.chat import (
     get_bedrock_response,
     insert_knowledge,
     prepare_conversation,
+    store_conversation_and_bot_last_used_time,
     trace_to_root,
 )
 from app.utils import get_anthropic_client, get_current_time, is_anthropic_model
@@ -221,7 +221,9 @@ def process_chat_input(
                 )
                 conversation.total_price += price
 
-                store_conversation(user_id, conversation)
+                store_conversation_and_bot_last_used_time(
+                    user_id, conversation, chat_input.bot_id
+                )
             else:
                 continue
     else:
@@ -291,7 +293,9 @@ def process_chat_input(
                     )
                     conversation.total_price += price
 
-                    store_conversation(user_id, conversation)
+                    store_conversation_and_bot_last_used_time(
+                        user_id, conversation, chat_input.bot_id
+                    )
 
     # Send last completion after saving conversation
     try:
@@ -306,11 +310,6 @@ def process_chat_input(
             "body": "Failed to send message to connection.",
         }
 
-    # Update bot last used time
-    if chat_input.bot_id:
-        logger.info("Bot id is provided. Updating bot last used time.")
-        modify_bot_last_used_time(user_id, chat_input.bot_id)
-
     return {"statusCode": 200, "body": "Message sent."}
 
 
@@ -1,19 +1,29 @@
+import json
 import sys
 import unittest
+from unittest.mock import patch
 
 sys.path.append(".")
 
 from app.config import DEFAULT_EMBEDDING_CONFIG
+from app.repositories.common import (
+    _get_dynamodb_client,
+    _get_table_client,
+    compose_conv_id,
+)
 from app.repositories.conversation import (
     ContentModel,
     ConversationModel,
+    LARGE_MESSAGE_BUCKET,
     MessageModel,
     RecordNotFoundError,
+    UnprocessedItemsError,
     change_conversation_title,
     delete_conversation_by_id,
     delete_conversation_by_user_id,
     find_conversation_by_id,
     find_conversation_by_user_id,
+    s3_client,
     store_conversation,
     update_feedback,
 )
@@ -31,6 +41,7 @@ from app.repositories.models.custom_bot import (
     SearchParamsModel,
 )
 from boto3.dynamodb.conditions import Key
+from boto3.dynamodb.types import Binary
 from botocore.exceptions import ClientError
 
 # class TestRowLevelAccess(unittest.TestCase):
@@ -294,6 +305,358 @@ class TestConversationRepository(unittest.TestCase):
         conversations = find_conversation_by_user_id(user_id="user")
         self.assertEqual(len(conversations), 0)
 
+    def test_store_and_find_compressed_conversation(self):
+        message_map = {
+            f"msg_{i}": MessageModel(
+                role="user",
+                content=[
+                    ContentModel(
+                        content_type="text",
+                        body="This is a large message."
+                        * 1000,  # Repeating to make it large
+                        media_type=None,
+                    )
+                ],
+                model="claude-instant-v1",
+                children=[],
+                parent=None,
+                create_time=1627984879.9,
+                feedback=None,
+                used_chunks=None,
+            )
+            for i in range(10)  # Create 10 large messages
+        }
+
+        compressed_conversation = ConversationModel(
+            id="3",
+            create_time=1627984879.9,
+            title="Compressed Conversation",
+            total_price=200,
+            message_map=message_map,
+            last_message_id="msg_9",
+            bot_id=None,
+        )
+
+        # Exceeds the threshold but fits after compression
+        store_conversation("user", compressed_conversation, threshold=100 * 1024)
+        item = _get_table_client("user").get_item(
+            Key={"PK": "user", "SK": compose_conv_id("user", "3")}
+        )["Item"]
+        self.assertFalse(item["IsLargeMessage"])
+        self.assertIsInstance(item["MessageMap"], Binary)
+
+        found_conversation = find_conversation_by_id(
+            user_id="user", conversation_id="3"
+        )
+        self.assertEqual(found_conversation.title, "Compressed Conversation")
+        self.assertEqual(len(found_conversation.message_map), 10)
+        for i in range(10):
+            message = found_conversation.message_map[f"msg_{i}"]
+            self.assertEqual(message.content[0].body, "This is a large message." * 1000)
+            self.assertEqual(message.create_time, 1627984879.9)
+
+        # Test give a feedback to compressed conversation
+        update_feedback(
+            user_id="user",
+            conversation_id="3",
+            message_id="msg_0",
+            feedback=FeedbackModel(thumbs_up=False, category="Bad", comment=""),
+        )
+        found_conversation = find_conversation_by_id(
+            user_id="user", conversation_id="3"
+        )
+        feedback = found_conversation.message_map["msg_0"].feedback
+        self.assertIsNotNone(feedback)
+        self.assertEqual(feedback.category, "Bad")  # type: ignore
+
+        delete_conversation_by_user_id(user_id="user")
+        conversations = find_conversation_by_user_id(user_id="user")
+        self.assertEqual(len(conversations), 0)
+
+    def test_large_conversation_is_removed_from_s3_after_compressed(self):
+        message_map = {
+            f"msg_{i}": MessageModel(
+                role="user",
+                content=[
+                    ContentModel(
+                        content_type="text",
+                        body="This is a large message." * 1000,
+                        media_type=None,
+                    )
+                ],
+                model="claude-instant-v1",
+                children=[],
+                parent=None,
+                create_time=1627984879.9,
+                feedback=None,
+                used_chunks=None,
+            )
+            for i in range(10)
+        }
+        conversation = ConversationModel(
+            id="6",
+            create_time=1627984879.9,
+            title="Large Conversation",
+            total_price=0,
+            message_map=message_map,
+            last_message_id="msg_9",
+            bot_id=None,
+        )
+
+        def list_large_messages():
+            response = s3_client.list_objects_v2(
+                Bucket=LARGE_MESSAGE_BUCKET, Prefix="user/"
+            )
+            return [obj["Key"] for obj in response.get("Contents", [])]
+
+        # Stored in S3 first
+        store_conversation("user", conversation, threshold=1)
+        self.assertEqual(list_large_messages(), ["user/6/message_map.json"])
+
+        # Then fits after compression
+        store_conversation("user", conversation, threshold=100 * 1024)
+        self.assertEqual(list_large_messages(), [])
+        found_conversation = find_conversation_by_id(
+            user_id="user", conversation_id="6"
+        )
+        self.assertEqual(len(found_conversation.message_map), 10)
+
+        delete_conversation_by_id(user_id="user", conversation_id="6")
+        self.assertEqual(list_large_messages(), [])
+
+    def test_find_and_delete_paginated_conversations(self):
+        for i in range(8):
+            store_conversation(
+                "user",
+                ConversationModel(
+                    id=str(i),
+                    create_time=1627984879.9 + i,
+                    title=f"Conversation {i}",
+                    total_price=0,
+                    message_map={
+                        "system": MessageModel(
+                            role="system",
+                            content=[
+                                ContentModel(
+                                    content_type="text", body="", media_type=None
+                                )
+                            ],
+                            model="claude-instant-v1",
+                            children=[],
+                            parent=None,
+                            create_time=1627984879.9,
+                            feedback=None,
+                            used_chunks=None,
+                        )
+                    },
+                    last_message_id="system",
+                    bot_id=None,
+                ),
+            )
+
+        client = _get_dynamodb_client("user")
+        query = client.query
+
+        # Return a single item per page
+        def paginated_query(**kwargs):
+            return query(**kwargs, Limit=1)
+
+        with patch.object(client, "query", side_effect=paginated_query) as mock:
+            conversations = find_conversation_by_user_id(user_id="user")
+        # Stop after `MAX_QUERY_COUNT` + 1 queries
+        self.assertEqual(mock.call_count, 6)
+        # Sorted by SK in descending order
+        self.assertEqual(
+            [conversation.id for conversation in conversations],
+            ["7", "6", "5", "4", "3", "2"],
+        )
+        for conversation in conversations:
+            self.assertEqual(conversation.title, f"Conversation {conversation.id}")
+            self.assertEqual(conversation.model, "claude-instant-v1")
+        # Each page starts from the last key of the previous page
+        for i, call in enumerate(mock.call_args_list[1:]):
+            self.assertEqual(
+                call.kwargs["ExclusiveStartKey"]["SK"]["S"],
+                compose_conv_id("user", str(7 - i)),
+            )
+
+        with patch.object(client, "query", side_effect=paginated_query) as mock:
+            delete_conversation_by_user_id(user_id="user")
+        # All pages are deleted regardless of `MAX_QUERY_COUNT`
+        self.assertGreaterEqual(mock.call_count, 8)
+        conversations = find_conversation_by_user_id(user_id="user")
+        self.assertEqual(len(conversations), 0)
+
+    def test_find_legacy_conversations_by_user_id(self):
+        # Conversations stored by older versions have no `FirstMessageModel`
+        # and `MessageMap` is stored as JSON string
+        table = _get_table_client("user")
+        for i in range(3):
+            table.put_item(
+                Item={
+                    "PK": "user",
+                    "SK": compose_conv_id("user", f"legacy_{i}"),
+                    "Title": f"Legacy Conversation {i}",
+                    "CreateTime": 1627984879 + i,
+                    "TotalPrice": 0,
+                    "LastMessageId": "a",
+                    "IsLargeMessage": False,
+                    "MessageMap": json.dumps(
+                        {
+                            "system": {
+                                "role": "system",
+                                "content": {
+                                    "content_type": "text",
+                                    "body": "",
+                                },
+                                "model": f"claude-v{i}",
+                                "children": ["a"],
+                                "parent": None,
+                                "create_time": 1627984879.9,
+                            },
+                        }
+                    ),
+                }
+            )
+
+        client = _get_dynamodb_client("user")
+        with patch.object(
+            client, "batch_get_item", wraps=client.batch_get_item
+        ) as batch_get_item:
+            conversations = find_conversation_by_user_id(user_id="user")
+
+        # Models of all legacy conversations are loaded with a single request
+        self.assertEqual(batch_get_item.call_count, 1)
+        self.assertEqual(len(conversations), 3)
+        for conversation in conversations:
+            i = conversation.id.split("_")[-1]
+            self.assertEqual(conversation.title, f"Legacy Conversation {i}")
+            self.assertEqual(conversation.model, f"claude-v{i}")
+
+        delete_conversation_by_user_id(user_id="user")
+        conversations = find_conversation_by_user_id(user_id="user")
+        self.assertEqual(len(conversations), 0)
+
+    def test_delete_conversation_by_user_id_retries_unprocessed_items(self):
+        conversation = ConversationModel(
+            id="4",
+            create_time=1627984879.9,
+            title="Test Conversation",
+            total_price=0,
+            message_map={
+                "a": MessageModel(
+                    role="user",
+                    content=[
+                        ContentModel(content_type="text", body="Hello", media_type=None)
+                    ],
+                    model="claude-instant-v1",
+                    children=[],
+                    parent=None,
+                    create_time=1627984879.9,
+                    feedback=None,
+                    used_chunks=None,
+                )
+            },
+            last_message_id="a",
+            bot_id=None,
+        )
+        store_conversation("user", conversation)
+
+        client = _get_dynamodb_client("user")
+        batch_write_item = client.batch_write_item
+
+        # Leave all items unprocessed on the first call
+        responses = []
+
+        def throttled_batch_write_item(RequestItems):
+            if not responses:
+                responses.append(RequestItems)
+                return {"UnprocessedItems": RequestItems}
+            return batch_write_item(RequestItems=RequestItems)
+
+        with patch.object(
+            client, "batch_write_item", side_effect=throttled_batch_write_item
+        ) as mock:
+            delete_conversation_by_user_id(user_id="user")
+        self.assertEqual(mock.call_count, 2)
+        conversations = find_conversation_by_user_id(user_id="user")
+        self.assertEqual(len(conversations), 0)
+
+        # Raise if items are still unprocessed after retries
+        store_conversation("user", conversation)
+        with patch.object(
+            client,
+            "batch_write_item",
+            side_effect=lambda RequestItems: {"UnprocessedItems": RequestItems},
+        ):
+            with self.assertRaises(UnprocessedItemsError):
+                delete_conversation_by_user_id(user_id="user")
+        conversations = find_conversation_by_user_id(user_id="user")
+        self.assertEqual(len(conversations), 1)
+
+        delete_conversation_by_user_id(user_id="user")
+
+    def test_find_and_update_legacy_conversation(self):
+        # `MessageMap` stored as JSON string by older versions
+        _get_table_client("user").put_item(
+            Item={
+                "PK": "user",
+                "SK": compose_conv_id("user", "5"),
+                "Title": "Legacy Conversation",
+                "CreateTime": 1627984879,
+                "TotalPrice": 0,
+                "LastMessageId": "a",
+                "IsLargeMessage": False,
+                "MessageMap": json.dumps(
+                    {
+                        "a": {
+                            "role": "user",
+                            # Content was a single object
+                            "content": {"content_type": "text", "body": "Hello"},
+                            "model": "claude-instant-v1",
+                            "children": [],
+                            "parent": None,
+                            "create_time": 1627984879.9,
+                        },
+                    }
+                ),
+            }
+        )
+
+        found_conversation = find_conversation_by_id(
+            user_id="user", conversation_id="5"
+        )
+        self.assertEqual(found_conversation.title, "Legacy Conversation")
+        message = found_conversation.message_map["a"]
+        self.assertEqual(message.role, "user")
+        self.assertEqual(len(message.content), 1)
+        self.assertEqual(message.content[0].body, "Hello")
+        self.assertEqual(message.content[0].media_type, None)
+        self.assertEqual(message.create_time, 1627984879.9)
+        self.assertIsNone(message.feedback)
+        self.assertIsNone(message.used_chunks)
+
+        # Feedback cannot be updated in place, so the conversation is rewritten as native map
+        update_feedback(
+            user_id="user",
+            conversation_id="5",
+            message_id="a",
+            feedback=FeedbackModel(thumbs_up=True, category="Good", comment=""),
+        )
+        item = _get_table_client("user").get_item(
+            Key={"PK": "user", "SK": compose_conv_id("user", "5")}
+        )["Item"]
+        self.assertIsInstance(item["MessageMap"], dict)
+        found_conversation = find_conversation_by_id(
+            user_id="user", conversation_id="5"
+        )
+        feedback = found_conversation.message_map["a"].feedback
+        self.assertIsNotNone(feedback)
+        self.assertEqual(feedback.category, "Good")  # type: ignore
+        self.assertEqual(found_conversation.message_map["a"].content[0].body, "Hello")
+
+        delete_conversation_by_user_id(user_id="user")
+
 
 class TestConversationBotRepository(unittest.TestCase):
     def setUp(self) -> None:
@@ -78,7 +78,14 @@ export class UsageAnalysis extends Construct {
       },
       {
         name: "MessageMap",
-        type: glue.Schema.struct([{ name: "S", type: glue.Schema.STRING }]),
+        // NOTE: `S` is JSON string stored by older versions.
+        // `M` is DynamoDB native map, declared as string to read the nested DynamoDB JSON as is.
+        // `B` is base64 encoded zstd compressed JSON for large conversations.
+        type: glue.Schema.struct([
+          { name: "S", type: glue.Schema.STRING },
+          { name: "M", type: glue.Schema.STRING },
+          { name: "B", type: glue.Schema.STRING },
+        ]),
       },
       {
         name: "IsLargeMessage",